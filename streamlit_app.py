@@ -1,11 +1,158 @@
 import requests
-import json
+import numpy as np
 import pandas as pd
 import streamlit as st
-import base64
-from icalendar import Calendar, Event
 from datetime import datetime, timezone, timedelta
 import matplotlib.pyplot as plt
+from scipy.interpolate import PchipInterpolator
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+# share one connection pool across all NOAA requests so keep-alive avoids a new TLS handshake per call
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# the NOAA predictions are requested in GMT
+_UTC = timezone.utc
+
+
+# called from a worker thread in TidePredictor.run, which has no script run context to show a spinner in
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_station_info(station_id):
+    """Retrieves the metadata of a station from the NOAA API, cached for an hour per station ID.
+
+    Args:
+        station_id (str): The ID of the station to retrieve information for.
+
+    Returns:
+        list: The 'stations' entry of the API response.
+
+    Raises:
+        requests.HTTPError: If the request is not successful. Failures are not cached.
+    """
+
+    endpoint = 'https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/stations/' + station_id + '.json'
+    response = _SESSION.get(endpoint)
+    response.raise_for_status()
+    return response.json()['stations']
+
+
+@st.cache_data(ttl=1800)
+def _fetch_predictions(station_id, begin_date, end_date, units):
+    """Retrieves the high/low tide predictions of a station from the NOAA API, cached for 30 minutes.
+
+    Only the parameters of the API request are part of the cache key, so changing the low and high
+    thresholds does not trigger a new request.
+
+    Args:
+        station_id (str): The ID of the station to retrieve tide data for.
+        begin_date (str): The start date of the tide data to retrieve in the format 'YYYYMMDD'.
+        end_date (str): The end date of the tide data to retrieve in the format 'YYYYMMDD'.
+        units (str): The units to retrieve the tide data in.
+
+    Returns:
+        pandas.DataFrame: The tide heights indexed by timestamp.
+
+    Raises:
+        requests.HTTPError: If the request is not successful. Failures are not cached.
+    """
+
+    base_url = "https://api.tidesandcurrents.noaa.gov/api/prod/datagetter"
+
+    params = {
+        "station": station_id,
+        "product": 'predictions',
+        "time_zone": 'GMT',
+        "begin_date": begin_date,
+        "end_date": end_date,
+        "units": units,
+        "datum": 'MLLW',
+        'interval': 'hilo',
+        "format": 'json',
+        "application": 'Web_Services'
+        }
+
+    response = _SESSION.get(base_url, params=params)
+    response.raise_for_status()
+
+    data = response.json()
+    results = data["predictions"]
+
+    # build the typed columns in a single pass over the records
+    timestamps = pd.to_datetime([r['t'] for r in results], format='%Y-%m-%d %H:%M')
+    heights = np.fromiter((r['v'] for r in results), dtype=np.float64, count=len(results))
+
+    return pd.DataFrame({'height': heights}, index=pd.DatetimeIndex(timestamps, name='timestamp'))
+
+
+def _tide_curve(tides):
+    """Builds the Piecewise Cubic Hermite Interpolating Polynomial (PCHIP) through the high/low tide predictions.
+
+    Args:
+        tides (pandas.DataFrame): The tide heights indexed by timestamp.
+
+    Returns:
+        scipy.interpolate.PchipInterpolator: The tide height as a function of the seconds since the first prediction.
+    """
+
+    x = (tides.index - tides.index[0]).total_seconds().to_numpy()
+    return PchipInterpolator(x, tides['height'].to_numpy())
+
+
+def _in_range(h, low=None, high=None):
+    """Tests which tide heights lie strictly between the low and high thresholds.
+
+    Args:
+        h (numpy.ndarray): The tide heights.
+        low (float, optional): The low tide threshold. Defaults to None.
+        high (float, optional): The high tide threshold. Defaults to None.
+
+    Returns:
+        numpy.ndarray: A boolean mask of the heights within the range.
+    """
+
+    mask = np.ones_like(h, dtype=bool)
+    if low is not None:
+        mask &= h > low
+    if high is not None:
+        mask &= h < high
+    return mask
+
+
+def _find_intervals(curve, low=None, high=None):
+    """Finds the spans where a tide curve lies strictly between the low and high thresholds.
+
+    PCHIP is monotonic between consecutive highs and lows, so the threshold crossings are solved for
+    segment by segment instead of sampling the curve.
+
+    Args:
+        curve (scipy.interpolate.PchipInterpolator): The tide curve, see _tide_curve.
+        low (float, optional): The low tide threshold. Defaults to None.
+        high (float, optional): The high tide threshold. Defaults to None.
+
+    Returns:
+        tuple: Two float arrays with the start and end of each interval in seconds since the first prediction.
+    """
+
+    # a high or low that only touches a threshold may not be reported as a root, so every prediction is a break too
+    breaks = [curve.x]
+    for threshold in (low, high):
+        if threshold is not None:
+            roots = curve.solve(threshold, extrapolate=False)
+            breaks.append(roots[np.isfinite(roots)])
+    breaks = np.unique(np.concatenate(breaks))
+
+    # the curve stays on one side of both thresholds between consecutive breaks, so test each span at its middle
+    inside = _in_range(curve((breaks[:-1] + breaks[1:]) / 2), low, high)
+    # neighbouring spans only form one interval if the break between them is inside the range as well
+    joined = inside[:-1] & inside[1:] & _in_range(curve(breaks[1:-1]), low, high)
+
+    starts = breaks[:-1][inside & ~np.concatenate([[False], joined])]
+    ends = breaks[1:][inside & ~np.concatenate([joined, [False]])]
+
+    return starts, ends
+
 
 class TidePredictor:
     """Initializes a TidePredictor object with the given parameters.
@@ -26,7 +173,7 @@ class TidePredictor:
         low (float): The low tide threshold in meters.
         high (float): The high tide threshold in meters.
         tides (pandas.DataFrame): The raw tide data retrieved from the API.
-        interpolated_tides (pandas.DataFrame): The tide data interpolated to 1-minute intervals.
+        interpolated_tides (pandas.DataFrame): The tide data interpolated to 1-minute intervals, computed when plotting.
         intervals (list): A list of tuples representing the start and end times of each high tide interval.
         station_info (dict): A dictionary containing information about the tide station.
     
@@ -58,33 +205,9 @@ class TidePredictor:
             None. The function stores the retrieved data in the instance variable 'tides' of the calling class.
         """
 
-        base_url = "https://api.tidesandcurrents.noaa.gov/api/prod/datagetter"
-
-        params = {
-            "station": self.station_id,
-            "product": 'predictions',
-            "time_zone": 'GMT',
-            "begin_date": self.begin_date,
-            "end_date": self.end_date,
-            "units": self.units,
-            "datum": 'MLLW',
-            'interval': 'hilo',
-            "format": 'json',
-            "application": 'Web_Services'
-            }
-
-        response = requests.get(base_url, params=params)
-
-        if response.status_code == 200:
-            data = json.loads(response.text)
-            results = data["predictions"]
-
-            self.tides = pd.DataFrame.from_dict(results)
-            self.tides.rename(columns={'t': 'timestamp', 'v': 'height'}, inplace=True)
-            self.tides['height'] = self.tides['height'].astype(float)
-            self.tides['timestamp'] = pd.to_datetime(self.tides['timestamp'])
-            self.tides.set_index('timestamp', inplace=True)
-        else:
+        try:
+            self.tides = _fetch_predictions(self.station_id, self.begin_date, self.end_date, self.units)
+        except requests.HTTPError:
             self.tides = None
 
 
@@ -97,13 +220,15 @@ class TidePredictor:
         Returns:
             None.
         """  
-        df  = self.tides[['height']]
+        index = self.tides.index
+        minutes = pd.date_range(index[0], index[-1], freq='1min')
+        h = _tide_curve(self.tides)((minutes - index[0]).total_seconds().to_numpy())
 
-        self.interpolated_tides = df.resample('1T').interpolate(method='pchip')
+        self.interpolated_tides = pd.DataFrame({'height': h}, index=minutes)
 
 
     def get_intervals(self):
-        """This function gets the intervals of time where the interpolated tides are within the specified range of low and high values. 
+        """This function gets the intervals of time where the tide curve is within the specified range of low and high values, to the minute. 
         
         Args:
             self: The object instance.
@@ -112,38 +237,23 @@ class TidePredictor:
             None. The function sets the intervals attribute of the object instance.
         """
         
-        intervals = []
-        start = None
-        end = None
-        
-        def check_interval(v):
-            if self.low is not None and self.high is not None:
-                return (v < self.high) and (v > self.low)
-            elif self.low is not None:
-                return v > self.low
-            elif self.high is not None:
-                return v < self.high
-            else:
-                return True
-
-        for t, v in self.interpolated_tides.itertuples():
-            if check_interval(v):
-                if start is None:
-                    start = t
-            else:
-                if start is not None:
-                    end = t
-                    intervals.append((start, end))
-                    start = None
-                    end = None
-        if start is not None and end is None:
-            intervals.append((start, self.interpolated_tides.index[-1]))
-            
-        self.intervals = intervals
+        t0 = self.tides.index[0]
+        curve = _tide_curve(self.tides)
+        starts, ends = _find_intervals(curve, self.low, self.high)
+
+        # round to whole minutes like the interpolated tides: an interval starts at its first minute inside the range
+        # and ends at its first minute outside it, and intervals that contain no full minute are dropped
+        starts = (t0 + pd.to_timedelta(starts, unit='s')).ceil('1min')
+        on_threshold = ~_in_range(curve((starts - t0).total_seconds().to_numpy()), self.low, self.high)
+        starts = starts + pd.to_timedelta(on_threshold.astype(np.int64), unit='min')
+        ends = (t0 + pd.to_timedelta(ends, unit='s')).ceil('1min')
+        self.intervals = [(start, end) for start, end in zip(starts, ends) if start < end]
 
 
     def plot_tides(self):
         # plot the highs and lows with a smooth line
+        if self.interpolated_tides is None:
+            self.interpolate_tides()
         fig, ax = plt.subplots()
         ax.plot(self.interpolated_tides.index, self.interpolated_tides['height'])
         ax.plot(self.tides.index, self.tides['height'], 'o', color='red')
@@ -177,13 +287,10 @@ class TidePredictor:
         Returns:
             None. The function sets the station_info attribute of the instance to the retrieved data if the request is successful. Otherwise, it prints an error message.
         """
-        
-        endpoint = 'https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/stations/' + self.station_id + '.json'
-        response = requests.get(endpoint)
-        if response.status_code == 200:
-            data = response.json()
-            self.station_info = data['stations']
-        else:
+
+        try:
+            self.station_info = _fetch_station_info(self.station_id)
+        except requests.HTTPError:
             print('Failed to retrieve  station info')
 
 
@@ -197,32 +304,29 @@ class TidePredictor:
         Returns:
             None."""
 
-        
-        cal = Calendar()
+        # imported here so loading the page does not pay for icalendar until a calendar is built
+        from icalendar import Calendar, Event
 
-        # set the timezone offset to GMT
-        tz_offset = timezone(timedelta(hours=0))
+        cal = Calendar()
 
-        # loop through events and add to calendar
+        # every event shares the same summary, so build it once
         station_name = self.station_info[0]['name']
+        summary = f'{station_name} min {self.low} max {self.high}'
+
+        # build the events and add them to the calendar in one go
+        events = []
         for start, stop in self.intervals:
             event = Event()
-            event.add('summary', f'{station_name} min {self.low} max {self.high}')
-            event.add('dtstart', start.replace(tzinfo=tz_offset))
-            event.add('dtend', stop.replace(tzinfo=tz_offset))
-            cal.add_component(event)
-
-        # write ical file
-        with open('mycalendar.ics', 'wb') as f:
-            f.write(cal.to_ical())
-            
-        # create a download button for the ical file
-        with open('mycalendar.ics', 'rb') as f:
-            contents = f.read()
-            b64 = base64.b64encode(contents).decode()
-            href = f'<a href="data:file/ics;base64,{b64}" download="mycalendar.ics">Download iCalendar file</a>'
-            st.markdown(href, unsafe_allow_html=True)
-            
+            event.add('summary', summary)
+            event.add('dtstart', start.replace(tzinfo=_UTC))
+            event.add('dtend', stop.replace(tzinfo=_UTC))
+            events.append(event)
+        cal.subcomponents.extend(events)
+
+        # create a download button serving the calendar straight from memory, without a rerun that would clear the results
+        st.download_button("Download iCalendar file", data=cal.to_ical(), file_name='mycalendar.ics', mime='text/calendar',
+                           on_click='ignore')
+
     def run(self):
         """This function runs the entire process of retrieving data, interpolating, and creating an iCalendar file.
         
@@ -232,10 +336,14 @@ class TidePredictor:
         Returns:
             None."""
         
-        self.get_tide_predictions()
-        self.interpolate_tides()
+        # the predictions and station info requests are independent, so fetch them concurrently;
+        # the worker thread only calls the cached _fetch_station_info, which is set up not to show a spinner
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            station_info = executor.submit(self.get_station_info)
+            self.get_tide_predictions()
+            station_info.result()
+
         self.get_intervals()
-        self.get_station_info()
         self.plot_tides()
         self.create_ical_file()
 